@@ -0,0 +1,617 @@
+"""
+Tests du client MCP contre une session factice (aucun serveur réseau) :
+reprise sur session coupée, fusion des appels concurrents, cache des
+réponses (TTL / LRU), invalidation au refresh de la liste et validation
+des arguments.
+"""
+
+import asyncio
+import contextlib
+import copy
+import inspect
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+from mcp.shared.exceptions import McpError
+from mcp.types import CallToolResult, ErrorData, ListToolsResult, TextContent, Tool
+from pydantic import ValidationError
+
+from tools import mcp_client as m
+
+
+def object_schema(**properties) -> dict:
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+    }
+
+
+SCRAPE_SCHEMA = object_schema(url={"type": "string"})
+WRITE_SCHEMA = object_schema(path={"type": "string"})
+
+
+class FakeServer:
+    """État du serveur MCP simulé : tools exposés et compteurs d'appels."""
+
+    def __init__(self):
+        self.tools = {"scrape_url": SCRAPE_SCHEMA, "write": WRITE_SCHEMA}
+        self.connects = 0
+        # tâches qui entrent dans / sortent de chaque ClientSession
+        self.enter_tasks = []
+        self.exit_tasks = []
+        self.list_calls = 0
+        self.calls = []
+        # exceptions levées, dans l'ordre, par les prochains call_tool()
+        self.failures = []
+        self.call_delay = 0.0
+        self.lock = threading.Lock()
+
+    def list_tools(self) -> ListToolsResult:
+        # objets neufs à chaque appel, comme un vrai list_tools()
+        return ListToolsResult(
+            tools=[
+                Tool(
+                    name=name,
+                    description=f"tool {name}",
+                    inputSchema=copy.deepcopy(schema),
+                )
+                for name, schema in self.tools.items()
+            ]
+        )
+
+    def call_result(self, name: str, arguments: dict) -> CallToolResult:
+        text = f"{name}:{sorted(arguments.items())}"
+        return CallToolResult(content=[TextContent(type="text", text=text)])
+
+
+@pytest.fixture
+def server(monkeypatch):
+    srv = FakeServer()
+
+    @contextlib.asynccontextmanager
+    async def fake_client(url, **kwargs):
+        srv.connects += 1
+        yield ("read", "write", None)
+
+    class FakeSession:
+        def __init__(self, read, write):
+            pass
+
+        async def __aenter__(self):
+            srv.enter_tasks.append(asyncio.current_task())
+            return self
+
+        async def __aexit__(self, *exc):
+            srv.exit_tasks.append(asyncio.current_task())
+
+        async def initialize(self):
+            return None
+
+        async def list_tools(self):
+            srv.list_calls += 1
+            return srv.list_tools()
+
+        async def call_tool(self, name, arguments):
+            with srv.lock:
+                srv.calls.append((name, arguments))
+            await asyncio.sleep(srv.call_delay)
+            if srv.failures:
+                raise srv.failures.pop(0)
+            return srv.call_result(name, arguments)
+
+    monkeypatch.setattr(m, "streamablehttp_client", fake_client)
+    monkeypatch.setattr(m, "ClientSession", FakeSession)
+    yield srv
+
+    m.run_async_blocking(m._close_sessions(), timeout=5)
+    m._invalidate_caches(m._default_valves().server_url)
+
+
+def make_tools(**valves) -> m.Tools:
+    tools = m.Tools()
+    if valves:
+        tools.valves = m.Tools.Valves(**valves)
+    tools.mcp_list_tools()
+    return tools
+
+
+# ============================================================
+# 🔁 Boucle de fond et pool de sessions
+# ============================================================
+
+
+def test_run_async_blocking_cancels_the_coroutine_on_timeout():
+    cancelled = threading.Event()
+
+    async def hang():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    with pytest.raises(TimeoutError):
+        m.run_async_blocking(hang(), timeout=0.1)
+    assert cancelled.wait(1)
+
+
+def test_run_async_blocking_refuses_to_block_the_background_loop():
+    async def nested():
+        with pytest.raises(RuntimeError):
+            m.run_async_blocking(asyncio.sleep(0))
+
+    m.run_async_blocking(nested(), timeout=1)
+
+
+def test_one_session_is_shared_by_every_call(server):
+    tools = make_tools()
+    hits = m._CACHE_STATS["hits"]
+    m.Tools().mcp_call_tool("write", '{"path": "a"}')
+    tools.mcp_call_tool("write", '{"path": "b"}')
+
+    assert server.connects == 1
+    assert m._CACHE_STATS["hits"] > hits
+
+
+def test_session_is_closed_by_the_task_that_opened_it(server):
+    make_tools()
+
+    m.run_async_blocking(m._close_sessions(), timeout=5)
+
+    assert server.exit_tasks == server.enter_tasks
+    assert not m._SESSION_CACHE
+
+
+def test_discarded_session_lets_in_flight_calls_finish(server):
+    tools = make_tools()
+    server.call_delay = 0.5
+
+    with ThreadPoolExecutor(1) as ex:
+        pending = ex.submit(tools.mcp_call_tool, "write", '{"path": "a"}')
+        time.sleep(0.2)
+        m._discard_session(tools.mcp_url)
+
+        assert '"isError":false' in pending.result()
+
+    deadline = time.monotonic() + 2
+    while not server.exit_tasks and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert server.exit_tasks == server.enter_tasks
+
+
+# ============================================================
+# 🔌 Session coupée : remplacement et nouvel essai
+# ============================================================
+
+SESSION_TERMINATED = McpError(ErrorData(code=32600, message="Session terminated"))
+
+
+def test_read_timeout_is_not_replayed_for_side_effect_tools(server):
+    tools = make_tools()
+    server.failures = [httpx.ReadTimeout("timed out")]
+
+    output = tools.mcp_call_tool("write", '{"path": "a"}')
+
+    assert output.startswith("Error while calling MCP tool 'write'")
+    assert len(server.calls) == 1
+    assert server.connects == 1
+    # la session cassée a tout de même été remplacée
+    assert '"isError":false' in tools.mcp_call_tool("write", '{"path": "b"}')
+    assert server.connects == 2
+
+
+@pytest.mark.parametrize("error", [httpx.ConnectError("refused"), SESSION_TERMINATED])
+def test_unsent_request_is_replayed_on_a_new_session(server, error):
+    tools = make_tools()
+    server.failures = [error]
+
+    output = tools.mcp_call_tool("write", '{"path": "a"}')
+
+    assert '"isError":false' in output
+    assert len(server.calls) == 2
+    assert server.connects == 2
+
+
+def test_idempotent_tool_is_replayed_after_read_timeout(server):
+    tools = make_tools(cacheable_tools="")
+    server.failures = [httpx.ReadTimeout("timed out")]
+
+    output = tools.mcp_call_tool("scrape_url", '{"url": "a"}')
+
+    assert '"isError":false' in output
+    assert len(server.calls) == 2
+
+
+def test_other_errors_keep_the_session(server):
+    tools = make_tools()
+    server.failures = [RuntimeError("boom")]
+
+    assert "boom" in tools.mcp_call_tool("write", '{"path": "a"}')
+    tools.mcp_call_tool("write", '{"path": "a"}')
+
+    assert len(server.calls) == 2
+    assert server.connects == 1
+
+
+# ============================================================
+# 🔀 Fusion des appels concurrents
+# ============================================================
+
+
+def test_concurrent_identical_idempotent_calls_are_coalesced(server):
+    tools = make_tools(cacheable_tools="")
+    server.call_delay = 0.2
+
+    with ThreadPoolExecutor(4) as ex:
+        outputs = list(
+            ex.map(
+                lambda _: tools.mcp_call_tool("scrape_url", '{"url": "a"}'), range(4)
+            )
+        )
+
+    assert len(set(outputs)) == 1
+    assert len(server.calls) == 1
+
+
+def test_cancelled_first_caller_does_not_fail_coalesced_waiters(server):
+    impatient = make_tools(cacheable_tools="", timeout=1)
+    patient = make_tools(cacheable_tools="", timeout=10)
+    server.call_delay = 1.5
+
+    with ThreadPoolExecutor(2) as ex:
+        first = ex.submit(impatient.mcp_call_tool, "scrape_url", '{"url": "a"}')
+        time.sleep(0.2)
+        second = ex.submit(patient.mcp_call_tool, "scrape_url", '{"url": "a"}')
+
+        assert "pas de réponse MCP" in first.result()
+        assert '"isError":false' in second.result()
+
+    assert len(server.calls) == 1
+    assert not m._INFLIGHT
+
+
+def test_non_idempotent_calls_are_not_coalesced(server):
+    tools = make_tools(cacheable_tools="")
+    server.call_delay = 0.1
+
+    with ThreadPoolExecutor(4) as ex:
+        list(ex.map(lambda _: tools.mcp_call_tool("write", '{"path": "a"}'), range(4)))
+
+    assert len(server.calls) == 4
+
+
+def test_args_without_exact_json_form_have_no_key():
+    assert m._canonical_args({"b": 1, "a": [1, 2]}) == '{"a":[1,2],"b":1}'
+    assert m._canonical_args({"a": object()}) is None
+
+
+# ============================================================
+# 💾 Cache des réponses
+# ============================================================
+
+
+def test_response_cache_ignores_argument_order(server):
+    tools = make_tools()
+
+    first = tools.mcp_call_tool("scrape_url", '{"url": "a"}')
+    second = tools.mcp_call_tool("scrape_url", '{ "url" : "a" }')
+
+    assert first == second
+    assert len(server.calls) == 1
+
+
+def test_response_cache_expires_after_ttl(server, monkeypatch):
+    tools = make_tools()
+    tools.mcp_call_tool("scrape_url", '{"url": "a"}')
+
+    monkeypatch.setattr(m, "_RESPONSE_CACHE_TTL", -1.0)
+    tools.mcp_call_tool("scrape_url", '{"url": "a"}')
+
+    assert len(server.calls) == 2
+
+
+def test_response_cache_evicts_least_recently_used(server, monkeypatch):
+    monkeypatch.setattr(m, "_RESPONSE_CACHE_MAX", 2)
+    tools = make_tools()
+
+    for url in ("a", "b", "a", "c"):  # "b" devient le moins récent, puis sort
+        tools.mcp_call_tool("scrape_url", f'{{"url": "{url}"}}')
+    assert len(server.calls) == 3
+
+    tools.mcp_call_tool("scrape_url", '{"url": "a"}')
+    assert len(server.calls) == 3
+    tools.mcp_call_tool("scrape_url", '{"url": "b"}')
+    assert len(server.calls) == 4
+
+
+def test_cached_outputs_follow_pretty_output(server):
+    tools = make_tools()
+    compact_schema = tools.mcp_get_tool_schema("scrape_url")
+    compact_call = tools.mcp_call_tool("scrape_url", '{"url": "a"}')
+
+    tools.valves = m.Tools.Valves(pretty_output=True)
+    pretty_schema = tools.mcp_get_tool_schema("scrape_url")
+    pretty_call = tools.mcp_call_tool("scrape_url", '{"url": "a"}')
+
+    assert "\n" not in compact_schema and "\n" in pretty_schema
+    assert "\n" not in compact_call and "\n" in pretty_call
+
+
+# ============================================================
+# 🔄 Refresh de la liste des tools
+# ============================================================
+
+
+def test_refresh_replaces_parameters_and_validator(server):
+    tools = make_tools(tools_cache_ttl=0)
+    assert "url" in tools.mcp_get_tool_schema("scrape_url")
+
+    server.tools["scrape_url"] = WRITE_SCHEMA
+    time.sleep(0.01)
+    schema = tools.mcp_get_tool_schema("scrape_url")
+
+    assert '"path"' in schema and '"url"' not in schema
+    assert "invalides" in tools.mcp_call_tool("scrape_url", '{"url": "a"}')
+    assert "invalides" not in tools.mcp_call_tool("scrape_url", '{"path": "a"}')
+
+
+@pytest.mark.skipif(m.fastjsonschema is None, reason="fastjsonschema absent")
+def test_validator_is_compiled_once_per_schema_content(server, monkeypatch):
+    compiled = []
+    compile_ = m.fastjsonschema.compile
+    monkeypatch.setattr(
+        m.fastjsonschema,
+        "compile",
+        lambda schema, **kw: compiled.append(schema) or compile_(schema, **kw),
+    )
+    tools = make_tools(tools_cache_ttl=0)
+
+    for _ in range(3):  # chaque refresh renvoie des objets Tool neufs
+        time.sleep(0.01)
+        tools.mcp_get_tool_schema("write")
+        tools.mcp_call_tool("write", '{"path": "a"}')
+    assert server.list_calls == 4
+    assert len(compiled) == 1
+
+    server.tools["write"] = SCRAPE_SCHEMA
+    time.sleep(0.01)
+    tools.mcp_get_tool_schema("write")
+    tools.mcp_call_tool("write", '{"url": "a"}')
+    assert len(compiled) == 2
+
+
+def test_refresh_drops_removed_tools(server):
+    tools = make_tools(tools_cache_ttl=0)
+    tools.mcp_get_tool_schema("write")
+
+    del server.tools["write"]
+    time.sleep(0.01)
+
+    assert "introuvable" in tools.mcp_get_tool_schema("write")
+    assert "Schéma non chargé" in tools.mcp_call_tool("write", '{"path": "a"}')
+    assert server.calls == []
+
+
+def test_list_tools_prefetches_every_schema(server):
+    tools = make_tools()
+
+    for name in ("scrape_url", "write"):
+        schema = m._loads(tools.mcp_get_tool_schema(name))
+        assert schema["parameters"] == server.tools[name]
+
+    assert server.list_calls == 1
+
+
+def test_schema_then_list_share_one_round_trip(server):
+    tools = m.Tools()
+
+    tools.mcp_get_tool_schema("scrape_url")  # cache froid
+    tools.mcp_list_tools()
+    assert server.list_calls == 1
+
+    tools.valves = m.Tools.Valves(tools_cache_ttl=0)
+    time.sleep(0.01)
+    tools.mcp_list_tools()
+    assert server.list_calls == 2
+
+
+def test_schema_is_served_from_cache_until_ttl(server):
+    tools = make_tools()
+    tools.mcp_get_tool_schema("scrape_url")
+    tools.mcp_get_tool_schema("scrape_url")
+    assert server.list_calls == 1
+
+    tools.valves = m.Tools.Valves(tools_cache_ttl=0)
+    time.sleep(0.01)
+    tools.mcp_get_tool_schema("scrape_url")
+    assert server.list_calls == 2
+
+
+def test_invalidate_forgets_tools(server):
+    tools = make_tools()
+    tools.mcp_cache_invalidate()
+
+    assert "Schéma non chargé" in tools.mcp_call_tool("scrape_url", '{"url": "a"}')
+    tools.mcp_get_tool_schema("scrape_url")
+    assert server.list_calls == 2
+
+
+# ============================================================
+# ✅ Validation des arguments
+# ============================================================
+
+
+def test_invalid_args_are_rejected_before_any_call(server):
+    tools = make_tools()
+
+    output = tools.mcp_call_tool("scrape_url", '{"nope": 1}')
+
+    assert output.startswith("❌ Arguments invalides")
+    assert server.calls == []
+
+
+@pytest.mark.skipif(m.fastjsonschema is None, reason="fastjsonschema absent")
+def test_validation_sends_args_unchanged(server):
+    server.tools["scrape_url"] = object_schema(url={"type": "string", "format": "uri"})
+    server.tools["scrape_url"]["properties"]["onlyMain"] = {
+        "type": "boolean",
+        "default": True,
+    }
+    tools = make_tools()
+    tools.mcp_get_tool_schema("scrape_url")
+
+    # `format` est une annotation pour la plupart des serveurs : pas de rejet
+    output = tools.mcp_call_tool("scrape_url", '{"url": "example.com/page"}')
+
+    assert "isError" in output
+    assert server.calls == [("scrape_url", {"url": "example.com/page"})]
+
+
+@pytest.mark.skipif(m.fastjsonschema is None, reason="fastjsonschema absent")
+def test_uncompilable_schema_leaves_validation_to_server(server):
+    # \p{L} : regex valide côté serveur, refusée par le module `re`
+    server.tools["scrape_url"] = object_schema(
+        url={"type": "string", "pattern": r"^\p{L}+$"}
+    )
+    tools = make_tools()
+    tools.mcp_get_tool_schema("scrape_url")
+
+    output = tools.mcp_call_tool("scrape_url", '{"url": "abc"}')
+
+    assert "isError" in output
+    assert len(server.calls) == 1
+
+
+@pytest.mark.skipif(m.fastjsonschema is None, reason="fastjsonschema absent")
+def test_remote_refs_are_never_fetched(server, monkeypatch):
+    fetched = []
+    monkeypatch.setattr(urllib.request, "urlopen", lambda *a, **k: fetched.append(a))
+    server.tools["scrape_url"] = object_schema(
+        url={"$ref": "http://127.0.0.1:9/x.json"}
+    )
+    tools = make_tools()
+    tools.mcp_get_tool_schema("scrape_url")
+
+    output = tools.mcp_call_tool("scrape_url", '{"url": "abc"}')
+
+    assert "isError" in output
+    assert fetched == []
+
+
+# ============================================================
+# 🔧 fix_json
+# ============================================================
+
+
+def test_fix_json_fast_path_skips_parsing(monkeypatch):
+    def fail(_):
+        raise AssertionError("parsing inutile")
+
+    monkeypatch.setattr(m, "_loads", fail)
+
+    assert m.fix_json("") == {}
+    assert m.fix_json("  {}\n") == {}
+
+
+def test_fix_json_parses_strict_json_then_repairs():
+    assert m.fix_json('{"url": "a", "n": [1, 2]}') == {"url": "a", "n": [1, 2]}
+    assert m.fix_json("{url: 'a', n: 2,}") == {"url": "a", "n": 2}
+    assert m.fix_json("{url: 'a', /* note */ n: 2}", use_json5=True) == {
+        "url": "a",
+        "n": 2,
+    }
+
+
+def test_tolerant_parsers_are_imported_on_first_use(monkeypatch):
+    monkeypatch.delattr(m.fix_json, "_json5", raising=False)
+    monkeypatch.delattr(m.fix_json, "_repair_json", raising=False)
+    monkeypatch.delitem(sys.modules, "json5", raising=False)
+
+    m.fix_json('{"url": "a"}')
+    assert not hasattr(m.fix_json, "_repair_json")
+
+    m.fix_json("{url: 'a'}")
+    assert m.fix_json._repair_json is sys.modules["json_repair"].repair_json
+    assert "json5" not in sys.modules
+
+    m.fix_json("{url: 'a'}", use_json5=True)
+    assert m.fix_json._json5 is sys.modules["json5"]
+
+
+# ============================================================
+# ⚡ Sérialisation (orjson / json)
+# ============================================================
+
+
+def test_dumps_falls_back_to_json_for_what_orjson_refuses():
+    big = {"n": 2**70}  # > 64 bits : refusé par orjson
+    assert m._loads(m._dumps(big)) == big
+    assert m._dumps({1: "é"}, pretty=False) == '{"1":"é"}'
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_json_helpers_with_and_without_orjson(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(m, "orjson", None)
+    elif m.orjson is None:
+        pytest.skip("orjson absent")
+    data = {"b": "é", "a": [1, 2]}
+
+    assert m._dumps(data, pretty=False) == '{"b":"é","a":[1,2]}'
+    assert m._dumps(data) == '{\n  "b": "é",\n  "a": [\n    1,\n    2\n  ]\n}'
+    assert m._canonical_args(data) == '{"a":[1,2],"b":"é"}'
+
+
+# ============================================================
+# 🌐 Client HTTP du transport
+# ============================================================
+
+
+def test_transport_uses_the_pooled_httpx_factory():
+    params = inspect.signature(m.streamablehttp_client).parameters
+    if "httpx_client_factory" not in params:
+        pytest.skip("python-mcp sans httpx_client_factory")
+    assert m._TRANSPORT_KWARGS == {"httpx_client_factory": m._httpx_client_factory}
+
+
+def test_httpx_factory_keeps_connections_alive(monkeypatch):
+    monkeypatch.setattr(m.httpx, "AsyncClient", lambda **kwargs: kwargs)
+
+    kwargs = m._httpx_client_factory(headers={"X-Test": "1"})
+
+    assert kwargs["headers"] == {"X-Test": "1"}
+    assert kwargs["limits"] is m._HTTPX_LIMITS
+    assert kwargs["http2"] is m._HTTP2
+    assert kwargs["follow_redirects"] is True
+    assert kwargs["timeout"] == httpx.Timeout(30, read=300)
+
+
+def test_httpx_factory_honours_the_transport_timeout():
+    timeout = httpx.Timeout(5, read=60)
+    client = m._httpx_client_factory(timeout=timeout)
+    try:
+        assert client.timeout == timeout
+    finally:
+        asyncio.run(client.aclose())
+
+
+# ============================================================
+# ⚙️ Valves
+# ============================================================
+
+
+def test_default_valves_are_shared_and_frozen():
+    first, second = m.Tools(), m.Tools()
+    assert first.valves is second.valves
+
+    with pytest.raises(ValidationError):
+        first.valves.timeout = 1
+
+    first.valves = m.Tools.Valves(timeout=1)
+    assert second.valves.timeout == 120
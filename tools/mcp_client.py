@@ -2,7 +2,7 @@
 title: MCP Python Client
 version: 3.0.0
 author: Lucas
-requirements: python-mcp, json5, json-repair
+requirements: python-mcp, json5, json-repair, uvloop; sys_platform != "win32", orjson, h2, fastjsonschema
 description: Client MCP officiel basé sur la lib python-mcp.
              Workflow sécurisé : list → schema → call.
              Auto-fix JSON LLM. Compatible FireCrawl, Browser, Playwright, etc.
@@ -10,74 +10,604 @@ description: Client MCP officiel basé sur la lib python-mcp.
 
 import os
 import json
-import json5
+import time
+import atexit
 import asyncio
-from json_repair import repair_json
-from pydantic import BaseModel, Field
+import threading
+import concurrent.futures
+import inspect
+import functools
+import importlib.util
+from collections import OrderedDict
+import anyio
+import httpx
+from pydantic import BaseModel, ConfigDict, Field
 
 from mcp import ClientSession
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED, Tool
 from mcp.client.streamable_http import streamablehttp_client
 
+try:
+    import orjson
+except ImportError:  # orjson absent → json de la stdlib
+    orjson = None
+
+try:
+    import fastjsonschema
+except ImportError:  # fastjsonschema absent → validation laissée au serveur
+    fastjsonschema = None
+
+try:
+    import uvloop
+except ImportError:  # Windows / uvloop absent → boucle asyncio standard
+    uvloop = None
+
 
 # ============================================================
-# 🔧 FIX JSON (tolère erreurs LLM)
+# 🔁 Boucle asyncio dédiée (thread de fond)
 # ============================================================
 
+# Toutes les I/O MCP tournent sur cette boucle : les sessions du pool y restent
+# attachées, et l'appelant sync n'a jamais à ré-entrer sa propre boucle.
+# uvloop est utilisé pour cette boucle seulement : la politique globale
+# d'OpenWebUI n'est pas modifiée.
+_BG_LOOP = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+_BG_THREAD = threading.Thread(
+    target=_BG_LOOP.run_forever, name="mcp-client-loop", daemon=True
+)
+_BG_THREAD.start()
+
 
-def run_async_blocking(coro):
+def run_async_blocking(coro, timeout: float | None = None):
     """
     Runs an async coroutine from sync code, even inside uvloop / FastAPI / OpenWebUI.
-    Returns the result (awaited).
+    The coroutine is scheduled on the background MCP loop; only the calling
+    thread blocks until the result is available (at most `timeout` seconds,
+    after which the coroutine is cancelled).
     """
+    if threading.current_thread() is _BG_THREAD:
+        coro.close()
+        raise RuntimeError(
+            "run_async_blocking() ne peut pas être appelé depuis la boucle MCP."
+        )
+
+    fut = asyncio.run_coroutine_threadsafe(coro, _BG_LOOP)
     try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        loop = None
+        return fut.result(timeout)
+    except concurrent.futures.TimeoutError:
+        fut.cancel()
+        raise TimeoutError(f"pas de réponse MCP après {timeout} s") from None
 
-    if loop and loop.is_running():
-        # uvloop running → schedule coro and wait for it
-        fut = asyncio.ensure_future(coro)
-        # Create a new event to block until completion
-        done_event = asyncio.Event()
 
-        def _done(_):
-            done_event.set()
+# ============================================================
+# 🔧 FIX JSON (tolère erreurs LLM)
+# ============================================================
 
-        fut.add_done_callback(_done)
 
-        # Block until coroutine completes
-        loop.run_until_complete(done_event.wait())
-        return fut.result()
+_loads = orjson.loads if orjson is not None else json.loads
 
-    else:
-        # No running loop → safe
-        return asyncio.run(coro)
 
+def _dumps(obj, pretty: bool = True) -> str:
+    """
+    Sérialise en JSON (UTF-8 brut), via orjson si disponible.
+    `pretty=False` → JSON compact : deux fois moins d'octets à encoder et de
+    tokens à relire pour le LLM.
+    """
+    if orjson is not None:
+        try:
+            if pretty:
+                return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            pass  # ex. clés non-str / entiers > 64 bits → json de la stdlib
+    if pretty:
+        return json.dumps(obj, indent=2, ensure_ascii=False)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
 
-def fix_json(data: str) -> dict:
+
+def fix_json(data: str, use_json5: bool = False) -> dict:
     """
     Répare automatiquement du JSON malformé.
-    - JSON natif
-    - JSON5
+    - JSON natif (chemin rapide, `""` / `"{}"` sans parsing)
+    - JSON5 (seulement si `use_json5=True` : très lent, rarement utile)
     - réparation json-repair
     """
-    try:
-        return json.loads(data)
-    except Exception:
-        pass
+    s = data.strip()
+    if s in ("", "{}"):
+        return {}
 
     try:
-        return json5.loads(data)
-    except Exception:
+        return _loads(s)
+    except ValueError:
         pass
 
+    # Parsers tolérants importés à la première utilisation seulement
+    if use_json5:
+        json5 = getattr(fix_json, "_json5", None)
+        if json5 is None:
+            import json5
+
+            fix_json._json5 = json5
+        try:
+            return json5.loads(s)
+        except ValueError:
+            pass
+
     try:
-        repaired = repair_json(data)
+        repair_json = getattr(fix_json, "_repair_json", None)
+        if repair_json is None:
+            from json_repair import repair_json
+
+            fix_json._repair_json = repair_json
+        repaired = repair_json(s)
         return json.loads(repaired)
     except Exception as e:
         raise ValueError(
             f"Impossible de parser/réparer le JSON.\nErreur : {e}\nEntrée : {data}"
+        ) from e
+
+
+# ============================================================
+# 🌐 Client HTTP du transport (keep-alive / HTTP/2)
+# ============================================================
+
+_HTTPX_LIMITS = httpx.Limits(max_keepalive_connections=32, keepalive_expiry=300)
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+def _httpx_client_factory(
+    headers: dict[str, str] | None = None,
+    timeout: httpx.Timeout | None = None,
+    auth: httpx.Auth | None = None,
+) -> httpx.AsyncClient:
+    """
+    Client httpx du transport streamable : connexions keep-alive longue durée
+    et HTTP/2 (appels concurrents multiplexés) si `h2` est installé.
+    Le client vit aussi longtemps que la session MCP du pool qui l'a créé.
+    """
+    return httpx.AsyncClient(
+        headers=headers,
+        timeout=timeout if timeout is not None else httpx.Timeout(30, read=300),
+        auth=auth,
+        follow_redirects=True,
+        http2=_HTTP2,
+        limits=_HTTPX_LIMITS,
+    )
+
+
+# Les anciennes versions de python-mcp n'acceptent pas de factory httpx
+if "httpx_client_factory" in inspect.signature(streamablehttp_client).parameters:
+    _TRANSPORT_KWARGS = {"httpx_client_factory": _httpx_client_factory}
+else:
+    _TRANSPORT_KWARGS = {}
+
+
+# ============================================================
+# 🔌 Pool de sessions MCP (une session persistante par URL)
+# ============================================================
+
+# url → (session initialisée, événement d'arrêt, tâche propriétaire,
+#        tâches qui utilisent la session)
+_SESSION_CACHE: dict[
+    str, tuple[ClientSession, asyncio.Event, asyncio.Task, set[asyncio.Task]]
+] = {}
+_SESSION_LOCK = asyncio.Lock()
+_SESSION_CLOSE_TIMEOUT = 5.0
+_SESSION_DRAIN_TIMEOUT = 30.0
+_CACHE_STATS = {
+    "hits": 0,
+    "misses": 0,
+    "init_seconds_last": 0.0,
+    "init_seconds_total": 0.0,
+    "coalesced_calls": 0,
+    "response_hits": 0,
+}
+
+
+async def _own_session(url: str, ready: asyncio.Future, stop: asyncio.Event):
+    """
+    Tâche propriétaire d'une session du pool : entre dans le transport et la
+    ClientSession, publie la session via `ready`, puis attend `stop`.
+    Les cancel scopes anyio du transport doivent être quittés par la tâche
+    qui y est entrée : seule cette tâche ouvre et ferme donc la session.
+    """
+    try:
+        async with streamablehttp_client(url, **_TRANSPORT_KWARGS) as (
+            read,
+            write,
+            *rest,
+        ):
+            async with ClientSession(read, write) as session:
+                await session.initialize()
+                ready.set_result(session)
+                await stop.wait()
+    except BaseException as e:
+        if not ready.done():
+            if isinstance(e, asyncio.CancelledError):
+                ready.cancel()
+            else:
+                ready.set_exception(e)
+        # après l'ouverture, une erreur de transport ferme simplement la session
+    finally:
+        # Transport mort ou arrêt demandé : la session quitte le pool
+        entry = _SESSION_CACHE.get(url)
+        if entry is not None and entry[1] is stop:
+            del _SESSION_CACHE[url]
+
+
+def _use_session(entry: tuple) -> ClientSession:
+    """
+    Enregistre la tâche courante comme utilisatrice de la session, jusqu'à sa fin.
+    """
+    users = entry[3]
+    task = asyncio.current_task()
+    if task is not None and task not in users:
+        users.add(task)
+        task.add_done_callback(users.discard)
+    return entry[0]
+
+
+async def _close_session(entry: tuple, drain: float = 0.0):
+    """
+    Ferme une session du pool : laisse jusqu'à `drain` secondes aux requêtes
+    en cours, arrête la tâche propriétaire, puis annule les requêtes restantes
+    (sans réponse possible, elles attendraient indéfiniment).
+    """
+    _session, stop, owner, users = entry
+    if drain and users:
+        await asyncio.wait(set(users), timeout=drain)
+    stop.set()
+    try:
+        await asyncio.wait_for(owner, _SESSION_CLOSE_TIMEOUT)
+    except Exception:
+        pass
+    for task in list(users):
+        task.cancel()
+
+
+def _is_session_error(e: BaseException) -> bool:
+    """
+    Erreur de transport / de session (serveur redémarré, connexion coupée…) :
+    la session doit être remplacée. Toute autre erreur la laisse en place.
+    """
+    if isinstance(
+        e,
+        (
+            httpx.HTTPError,
+            anyio.ClosedResourceError,
+            anyio.BrokenResourceError,
+            anyio.EndOfStream,
+        ),
+    ):
+        return True
+    if isinstance(e, McpError):
+        return (
+            e.error.code == CONNECTION_CLOSED or e.error.message == "Session terminated"
+        )
+    return False
+
+
+def _is_unsent_error(e: BaseException) -> bool:
+    """
+    Erreur de session levée avant que la requête n'atteigne le serveur
+    (connexion refusée, transport déjà fermé, session inconnue du serveur) :
+    l'appel n'a pas pu s'exécuter, le rejouer est sans risque.
+    """
+    if isinstance(
+        e,
+        (
+            httpx.ConnectError,
+            httpx.ConnectTimeout,
+            anyio.ClosedResourceError,
+            anyio.BrokenResourceError,
+        ),
+    ):
+        return True
+    return isinstance(e, McpError) and e.error.message == "Session terminated"
+
+
+def _discard_session(url: str, session: ClientSession | None = None) -> None:
+    """
+    Retire la session de `url` du pool (serveur redémarré, transport cassé…)
+    et la ferme en arrière-plan. Le prochain appel rouvrira une session neuve.
+    Si `session` est donnée, ne retire l'entrée que si c'est encore elle.
+    """
+    entry = _SESSION_CACHE.get(url)
+    if entry is None or (session is not None and entry[0] is not session):
+        return
+    del _SESSION_CACHE[url]
+    if not _BG_LOOP.is_running():
+        return
+    try:
+        # L'appelant passe à une autre session : il ne doit pas être annulé
+        entry[3].discard(asyncio.current_task())
+    except RuntimeError:
+        pass  # appelé hors de la boucle MCP
+    asyncio.run_coroutine_threadsafe(
+        _close_session(entry, drain=_SESSION_DRAIN_TIMEOUT), _BG_LOOP
+    )
+
+
+async def _close_sessions():
+    """
+    Ferme proprement toutes les sessions du pool.
+    """
+    entries = list(_SESSION_CACHE.values())
+    _SESSION_CACHE.clear()
+    await asyncio.gather(*(_close_session(e) for e in entries))
+
+
+@atexit.register
+def _shutdown_sessions():
+    try:
+        if _SESSION_CACHE:
+            run_async_blocking(_close_sessions(), timeout=_SESSION_CLOSE_TIMEOUT + 1)
+    except Exception:
+        pass
+    finally:
+        _BG_LOOP.call_soon_threadsafe(_BG_LOOP.stop)
+
+
+# ============================================================
+# 🗂️ Cache des tools / schémas (partagé entre instances Tools)
+# ============================================================
+
+# url → {nom du tool → mcp.types.Tool renvoyé par list_tools()}
+_TOOLS_CACHE: dict[str, dict[str, Tool]] = {}
+# url → instant (monotonic) du dernier list_tools()
+_TOOLS_FETCHED_AT: dict[str, float] = {}
+# url → {nom du tool → schéma exposé au LLM}
+_SCHEMA_CACHE: dict[str, dict[str, dict]] = {}
+_TOOLS_CACHE_LOCK = threading.Lock()
+# url → verrou asyncio : un seul list_tools() en vol par serveur
+_LIST_TOOLS_LOCKS: dict[str, asyncio.Lock] = {}
+# (url, nom du tool) → (schéma des paramètres, validateur compilé ou None)
+_VALIDATOR_CACHE: dict[tuple[str, str], tuple[dict, object]] = {}
+# Sorties déjà sérialisées : url → JSON de mcp_list_tools,
+# url → {(nom du tool, pretty_output) → JSON du schéma}
+_LIST_TOOLS_JSON: dict[str, str] = {}
+_SCHEMA_JSON_CACHE: dict[str, dict[tuple[str, bool], str]] = {}
+
+
+def _store_tools(url: str, tools: list[Tool]) -> dict[str, Tool]:
+    """
+    Indexe par nom les tools renvoyés par `list_tools()` pour `url` et
+    précharge le schéma de chacun : un seul aller-retour réseau suffit
+    ensuite pour tous les mcp_get_tool_schema().
+    """
+    by_name = {t.name: t for t in tools}
+    schemas = {name: _build_schema(t) for name, t in by_name.items()}
+    with _TOOLS_CACHE_LOCK:
+        _TOOLS_CACHE[url] = by_name
+        _TOOLS_FETCHED_AT[url] = time.monotonic()
+        # remplacé, pas fusionné : un tool retiré du serveur disparaît du cache
+        _SCHEMA_CACHE[url] = schemas
+        _LIST_TOOLS_JSON.pop(url, None)
+        _SCHEMA_JSON_CACHE.pop(url, None)
+    return by_name
+
+
+def _store_json(
+    url: str, key: tuple[str, bool] | None, output: str, fetched_at: float | None
+) -> None:
+    """
+    Mémorise la sortie sérialisée de mcp_list_tools (`key` None) ou de
+    mcp_get_tool_schema (`key` = (nom du tool, pretty_output)), sauf si la
+    liste des tools a été rafraîchie ou invalidée depuis son calcul
+    (`fetched_at` différent) : le JSON serait périmé.
+    """
+    with _TOOLS_CACHE_LOCK:
+        if fetched_at is None or _TOOLS_FETCHED_AT.get(url) != fetched_at:
+            return
+        if key is None:
+            _LIST_TOOLS_JSON[url] = output
+        else:
+            _SCHEMA_JSON_CACHE.setdefault(url, {})[key] = output
+
+
+def _invalidate_caches(url: str) -> None:
+    """
+    Oublie tout ce qui est en cache pour `url` (la session MCP reste ouverte).
+    """
+    with _TOOLS_CACHE_LOCK:
+        _TOOLS_CACHE.pop(url, None)
+        _TOOLS_FETCHED_AT.pop(url, None)
+        _SCHEMA_CACHE.pop(url, None)
+        _LIST_TOOLS_JSON.pop(url, None)
+        _SCHEMA_JSON_CACHE.pop(url, None)
+        for key in [k for k in _VALIDATOR_CACHE if k[0] == url]:
+            del _VALIDATOR_CACHE[key]
+    with _RESPONSE_CACHE_LOCK:
+        for key in [k for k in _RESPONSE_CACHE if k[0] == url]:
+            del _RESPONSE_CACHE[key]
+
+
+class _RefuseRemoteRefs(dict):
+    """
+    `handlers` pour fastjsonschema couvrant tous les schémas d'URL : un `$ref`
+    distant fourni par le serveur n'est jamais téléchargé par le client
+    (sans handler, fastjsonschema ferait un `urlopen` synchrone).
+    """
+
+    def __contains__(self, scheme):
+        return True
+
+    def __getitem__(self, scheme):
+        return _refuse_remote_ref
+
+
+def _refuse_remote_ref(uri: str):
+    raise ValueError(f"$ref distant refusé : {uri}")
+
+
+_NO_REMOTE_REFS = _RefuseRemoteRefs()
+
+
+def _validate_args(url: str, tool_name: str, parameters: dict, args) -> None:
+    """
+    Valide `args` contre le schéma des paramètres avant tout appel réseau.
+    Le validateur est compilé une seule fois par schéma (fastjsonschema) et
+    survit aux refresh qui renvoient le même schéma ;
+    lève ValueError si les arguments sont invalides.
+    """
+    key = (url, tool_name)
+    entry = _VALIDATOR_CACHE.get(key)
+    # comparaison par contenu : chaque list_tools() renvoie des objets neufs
+    if entry is not None and entry[0] == parameters:
+        validate = entry[1]
+    else:
+        # Premier appel, ou schéma modifié côté serveur → recompilation
+        validate = None
+        if fastjsonschema is not None:
+            try:
+                # ni defaults injectés dans `args`, ni `format` appliqué :
+                # les arguments partent tels quels, le serveur reste juge
+                validate = fastjsonschema.compile(
+                    parameters,
+                    handlers=_NO_REMOTE_REFS,
+                    use_default=False,
+                    use_formats=False,
+                )
+            except Exception:
+                # Schéma non compilable (regex JS, $ref distant…) :
+                # le serveur validera
+                pass
+        with _TOOLS_CACHE_LOCK:
+            _VALIDATOR_CACHE[key] = (parameters, validate)
+
+    if validate is not None:
+        validate(args)
+
+
+def _build_schema(tool: Tool) -> dict:
+    return {
+        "name": tool.name,
+        "description": tool.description,
+        # inputSchema est déjà le JSON schema (dict) des paramètres
+        "parameters": tool.inputSchema,
+    }
+
+
+# ============================================================
+# 🔀 Déduplication des appels identiques en vol
+# ============================================================
+
+# (url, nom du tool, arguments canoniques)
+#   → [tâche de l'appel partagé, nombre d'appelants en attente]
+_INFLIGHT: dict[tuple[str, str, str], list] = {}
+
+
+@functools.lru_cache(maxsize=32)
+def _tool_names(names: str) -> frozenset[str]:
+    """
+    "a, b,c" → frozenset({"a", "b", "c"})
+    """
+    return frozenset(n.strip() for n in names.split(",") if n.strip())
+
+
+def _json_default(obj):
+    # ex. objets pydantic laissés dans les arguments
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json")
+    # pas de str(obj) : deux objets distincts pourraient donner la même clé
+    raise TypeError(f"{type(obj).__name__} non sérialisable")
+
+
+def _canonical_args(args: dict) -> str | None:
+    """
+    Représentation canonique (clés triées, compacte) des arguments d'un appel,
+    utilisée comme clé de cache / de déduplication.
+    None si les arguments n'ont pas de forme JSON exacte : l'appel ne doit
+    alors être ni fusionné ni mis en cache.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                args, option=orjson.OPT_SORT_KEYS, default=_json_default
+            ).decode()
+        except TypeError:
+            pass  # ex. clés non-str → json de la stdlib
+    try:
+        return json.dumps(
+            args,
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+            default=_json_default,
         )
+    except (TypeError, ValueError):
+        return None
+
+
+async def _coalesce(key: tuple[str, str, str], call, *args):
+    """
+    Exécute `call(*args)` une seule fois pour des appels concurrents de même `key` :
+    les appels suivants attendent le résultat du premier.
+    L'appel partagé tourne dans sa propre tâche : l'annulation d'un appelant
+    (timeout, session fermée) n'échoue pas les autres ; la tâche n'est annulée
+    que lorsque plus personne ne l'attend.
+    Ne doit être utilisé que pour des tools sans effet de bord.
+    """
+    entry = _INFLIGHT.get(key)
+    if entry is None:
+        task = asyncio.get_running_loop().create_task(call(*args))
+        entry = _INFLIGHT[key] = [task, 0]
+        task.add_done_callback(functools.partial(_inflight_done, key, entry))
+    else:
+        _CACHE_STATS["coalesced_calls"] += 1
+
+    task = entry[0]
+    entry[1] += 1
+    try:
+        return await asyncio.shield(task)
+    finally:
+        entry[1] -= 1
+        if not entry[1] and not task.done():
+            task.cancel()
+
+
+def _inflight_done(key: tuple[str, str, str], entry: list, task: asyncio.Task):
+    if _INFLIGHT.get(key) is entry:
+        del _INFLIGHT[key]
+    if not task.cancelled():
+        task.exception()  # évite le warning "exception was never retrieved"
+
+
+# ============================================================
+# 💾 Cache des réponses (tools en lecture seule)
+# ============================================================
+
+_RESPONSE_CACHE_MAX = 128
+_RESPONSE_CACHE_TTL = 300.0
+
+# (url, nom du tool, arguments canoniques, pretty_output)
+#   → (instant monotonic, JSON renvoyé), LRU
+_RESPONSE_CACHE: OrderedDict[tuple[str, str, str, bool], tuple[float, str]] = (
+    OrderedDict()
+)
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+
+def _cached_response(key: tuple[str, str, str, bool]) -> str | None:
+    with _RESPONSE_CACHE_LOCK:
+        entry = _RESPONSE_CACHE.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > _RESPONSE_CACHE_TTL:
+            del _RESPONSE_CACHE[key]
+            return None
+        _RESPONSE_CACHE.move_to_end(key)
+        _CACHE_STATS["response_hits"] += 1
+        return entry[1]
+
+
+def _store_response(key: tuple[str, str, str, bool], output: str) -> None:
+    with _RESPONSE_CACHE_LOCK:
+        _RESPONSE_CACHE[key] = (time.monotonic(), output)
+        _RESPONSE_CACHE.move_to_end(key)
+        while len(_RESPONSE_CACHE) > _RESPONSE_CACHE_MAX:
+            _RESPONSE_CACHE.popitem(last=False)
 
 
 # ============================================================
@@ -87,33 +617,197 @@ def fix_json(data: str) -> dict:
 
 class Tools:
     class Valves(BaseModel):
+        # Immuable : une même instance peut être partagée entre plusieurs Tools
+        model_config = ConfigDict(frozen=True)
+
         server_url: str = Field(
             "http://host.docker.internal:40001/firecrawl-mcp/mcp",
             description="URL de ton serveur MCP (HTTP streamable).",
         )
+        tools_cache_ttl: int = Field(
+            60,
+            description="Durée (s) pendant laquelle la liste des tools reste en cache.",
+        )
+        idempotent_tools: str = Field(
+            "scrape_url,search,fetch",
+            description=(
+                "Tools sans effet de bord (séparés par des virgules) : "
+                "les appels identiques simultanés sont fusionnés, et rejoués "
+                "si la session est coupée en cours d'appel."
+            ),
+        )
+        cacheable_tools: str = Field(
+            "scrape_url,search,fetch",
+            description=(
+                "Tools en lecture seule (séparés par des virgules) dont les "
+                "réponses sont mises en cache 5 minutes."
+            ),
+        )
+        pretty_output: bool = Field(
+            False,
+            description=(
+                "JSON indenté pour les schémas et résultats de tools "
+                "(sinon compact, moins de tokens). mcp_list_tools reste indenté."
+            ),
+        )
+        timeout: int = Field(
+            120,
+            description="Délai max (s) d'attente d'une réponse du serveur MCP.",
+        )
 
     def __init__(self):
-        # OpenWebUI va injecter `valves` automatiquement
-        self.valves = self.Valves()
+        # OpenWebUI va injecter `valves` automatiquement ; d'ici là, les
+        # valeurs par défaut sont partagées plutôt que revalidées à chaque Tools()
+        self.valves = _default_valves()
         self.mcp_url = self.valves.server_url
 
         # Cache interne
         self._tools_list: list[dict] = []
-        self._schema_cache: dict[str, dict] = {}
+
+    @property
+    def _tools_fresh(self) -> bool:
+        """
+        True si la liste des tools de `self.mcp_url` a moins de `tools_cache_ttl`.
+        """
+        fetched_at = _TOOLS_FETCHED_AT.get(self.mcp_url)
+        if fetched_at is None:
+            return False
+        return time.monotonic() - fetched_at <= self.valves.tools_cache_ttl
+
+    @property
+    def _tools_by_name(self) -> dict[str, Tool]:
+        """
+        Tools connus pour `self.mcp_url`, vide si la liste a expiré.
+        """
+        if not self._tools_fresh:
+            return {}
+        return _TOOLS_CACHE.get(self.mcp_url, {})
+
+    @property
+    def _schema_cache(self) -> dict[str, dict]:
+        with _TOOLS_CACHE_LOCK:
+            return _SCHEMA_CACHE.setdefault(self.mcp_url, {})
+
+    @property
+    def _schema_json_cache(self) -> dict[tuple[str, bool], str]:
+        with _TOOLS_CACHE_LOCK:
+            return _SCHEMA_JSON_CACHE.setdefault(self.mcp_url, {})
 
     # ============================================================
     # 🔹 Helpers MCP (async)
     # ============================================================
 
-    async def _with_session(self, coro):
+    async def _get_session(self) -> ClientSession:
         """
-        Helper pour créer une session MCP HTTP streamable, l'initialiser,
-        et exécuter une coroutine qui reçoit la session.
+        Retourne la session MCP persistante associée à `self.mcp_url`.
+        Au premier appel, ouvre le transport HTTP streamable, crée la
+        ClientSession et l'initialise une seule fois ; les appels suivants
+        réutilisent la même session.
         """
-        async with streamablehttp_client(self.mcp_url) as (read, write, *rest):
-            async with ClientSession(read, write) as session:
-                await session.initialize()
-                return await coro(session)
+        entry = _SESSION_CACHE.get(self.mcp_url)
+        # tâche propriétaire terminée → transport mort, session inutilisable
+        if entry is not None and not entry[2].done():
+            _CACHE_STATS["hits"] += 1
+            return _use_session(entry)
+
+        async with _SESSION_LOCK:
+            entry = _SESSION_CACHE.get(self.mcp_url)
+            if entry is not None and not entry[2].done():
+                _CACHE_STATS["hits"] += 1
+                return _use_session(entry)
+
+            _CACHE_STATS["misses"] += 1
+
+            start = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            ready = loop.create_future()
+            stop = asyncio.Event()
+            owner = loop.create_task(_own_session(self.mcp_url, ready, stop))
+            try:
+                session = await ready
+            except BaseException:
+                stop.set()
+                owner.cancel()
+                raise
+
+            elapsed = time.perf_counter() - start
+            _CACHE_STATS["init_seconds_last"] = elapsed
+            _CACHE_STATS["init_seconds_total"] += elapsed
+
+            entry = (session, stop, owner, set())
+            _SESSION_CACHE[self.mcp_url] = entry
+            return _use_session(entry)
+
+    async def _with_session(self, method, *args, replay: bool = True):
+        """
+        Exécute `method(*args)`. Si la session du pool est cassée (serveur
+        redémarré, session expirée…), la remplace et réessaie une seule fois.
+        `replay=False` (tool à effet de bord) : pas de nouvel essai si le
+        serveur a pu recevoir la requête (timeout de lecture, connexion coupée).
+        """
+        session = await self._get_session()
+        try:
+            return await method(*args)
+        except Exception as e:
+            if not _is_session_error(e):
+                raise
+            _discard_session(self.mcp_url, session)
+            if not replay and not _is_unsent_error(e):
+                raise
+            return await method(*args)
+
+    async def _fetch_tools(self) -> dict[str, Tool]:
+        """
+        Tools de `self.mcp_url` : la liste en cache tant qu'elle a moins de
+        `tools_cache_ttl`, sinon `list_tools()` sur le serveur (cache mis à jour).
+        Si un autre appel a rafraîchi la liste pendant l'attente du verrou,
+        son résultat est réutilisé sans nouvel aller-retour.
+        """
+        requested_at = time.monotonic()
+        lock = _LIST_TOOLS_LOCKS.setdefault(self.mcp_url, asyncio.Lock())
+
+        async with lock:
+            with _TOOLS_CACHE_LOCK:
+                fetched_at = _TOOLS_FETCHED_AT.get(self.mcp_url)
+                tools = _TOOLS_CACHE.get(self.mcp_url)
+            if tools is not None and (
+                fetched_at >= requested_at
+                or time.monotonic() - fetched_at <= self.valves.tools_cache_ttl
+            ):
+                return tools
+
+            session = await self._get_session()
+            list_result = await session.list_tools()
+            return _store_tools(self.mcp_url, list_result.tools)
+
+    async def _list_tools_impl(self) -> tuple[float | None, list[dict]]:
+        tools = await self._fetch_tools()
+        fetched_at = _TOOLS_FETCHED_AT.get(self.mcp_url)
+        cleaned = []
+        for t in tools.values():
+            cleaned.append(
+                {
+                    "name": t.name,
+                    "description": t.description,
+                }
+            )
+        self._tools_list = cleaned
+        return fetched_at, cleaned
+
+    async def _get_schema_impl(self, tool_name: str) -> tuple[float | None, dict]:
+        await self._fetch_tools()
+        fetched_at = _TOOLS_FETCHED_AT.get(self.mcp_url)
+        schema = self._schema_cache.get(tool_name)
+        if schema is None:
+            # tool inconnu : réponse non mémorisée
+            return None, {"error": f"Tool '{tool_name}' introuvable."}
+        return fetched_at, schema
+
+    async def _call_tool_impl(self, tool_name: str, args: dict) -> dict:
+        session = await self._get_session()
+        call_result = await session.call_tool(tool_name, arguments=args)
+        # call_result est un CallToolResult (pydantic)
+        return call_result.model_dump(mode="json")
 
     # ============================================================
     # 1️⃣ LIST TOOLS (name + description seulement)
@@ -128,26 +822,20 @@ class Tools:
         👉 Le LLM DOIT appeler cette fonction avant toute autre.
         """
 
-        async def _run():
-            async def _list(session: ClientSession):
-                list_result = await session.list_tools()
-                cleaned = []
-                for t in list_result.tools:
-                    fn = t.function
-                    cleaned.append(
-                        {
-                            "name": fn.name,
-                            "description": fn.description,
-                        }
-                    )
-                self._tools_list = cleaned
-                return cleaned
-
-            return await self._with_session(_list)
-
         try:
-            result = run_async_blocking(_run())
-            return json.dumps(result, indent=2, ensure_ascii=False)
+            # Liste encore fraîche → JSON déjà sérialisé
+            if self._tools_by_name:
+                output = _LIST_TOOLS_JSON.get(self.mcp_url)
+                if output is not None:
+                    return output
+
+            fetched_at, result = run_async_blocking(
+                self._with_session(self._list_tools_impl),
+                timeout=self.valves.timeout,
+            )
+            output = _dumps(result)  # lue telle quelle dans l'UI : toujours indentée
+            _store_json(self.mcp_url, None, output, fetched_at)
+            return output
         except Exception as e:
             return f"Error while listing MCP tools: {str(e)}"
 
@@ -165,28 +853,31 @@ class Tools:
         👉 Le LLM DOIT appeler ceci AVANT mcp_call_tool().
         """
 
-        async def _run():
-            async def _get_schema(session: ClientSession):
-                list_result = await session.list_tools()
-
-                for t in list_result.tools:
-                    fn = t.function
-                    if fn.name == tool_name:
-                        schema = {
-                            "name": fn.name,
-                            "description": fn.description,
-                            "parameters": fn.parameters.model_json_schema(),
-                        }
-                        self._schema_cache[tool_name] = schema
-                        return schema
-
-                return {"error": f"Tool '{tool_name}' introuvable."}
-
-            return await self._with_session(_get_schema)
-
+        key = (tool_name, self.valves.pretty_output)
         try:
-            result = run_async_blocking(_run())
-            return json.dumps(result, indent=2, ensure_ascii=False)
+            result = None
+            # liste expirée → on repasse par le serveur (étape 2)
+            if self._tools_fresh:
+                # 0) JSON déjà sérialisé
+                output = self._schema_json_cache.get(key)
+                if output is not None:
+                    return output
+
+                # 1) schéma déjà construit (préchargé par mcp_list_tools)
+                with _TOOLS_CACHE_LOCK:
+                    fetched_at = _TOOLS_FETCHED_AT.get(self.mcp_url)
+                    result = _SCHEMA_CACHE.get(self.mcp_url, {}).get(tool_name)
+
+            # 2) dernier recours : list_tools() sur le serveur
+            if result is None:
+                fetched_at, result = run_async_blocking(
+                    self._with_session(self._get_schema_impl, tool_name),
+                    timeout=self.valves.timeout,
+                )
+
+            output = _dumps(result, self.valves.pretty_output)
+            _store_json(self.mcp_url, key, output, fetched_at)
+            return output
         except Exception as e:
             return f"Error while getting MCP tool schema: {str(e)}"
 
@@ -211,7 +902,8 @@ class Tools:
         3) mcp_call_tool
         """
 
-        if tool_name not in self._schema_cache:
+        schema = self._schema_cache.get(tool_name)
+        if schema is None:
             return (
                 f"⚠️ Schéma non chargé pour `{tool_name}`.\n"
                 f"Veuillez appeler d’abord : mcp_get_tool_schema('{tool_name}')"
@@ -222,16 +914,77 @@ class Tools:
         except Exception as e:
             return f"❌ Erreur JSON : {e}"
 
-        async def _run():
-            async def _call(session: ClientSession):
-                call_result = await session.call_tool(tool_name, arguments=args)
-                # call_result est un CallToolResult (pydantic)
-                return call_result.model_dump(mode="json")
-
-            return await self._with_session(_call)
+        try:
+            _validate_args(self.mcp_url, tool_name, schema["parameters"], args)
+        except ValueError as e:
+            return f"❌ Arguments invalides pour `{tool_name}` : {e}"
+
+        idempotent = tool_name in _tool_names(self.valves.idempotent_tools)
+        coalesce = idempotent
+        cacheable = tool_name in _tool_names(self.valves.cacheable_tools)
+        if coalesce or cacheable:
+            canonical = _canonical_args(args)
+            if canonical is None:
+                coalesce = cacheable = False
+            else:
+                key = (self.mcp_url, tool_name, canonical)
+                # la sortie mise en cache dépend aussi de l'indentation demandée
+                response_key = (*key, self.valves.pretty_output)
+
+        if cacheable:
+            output = _cached_response(response_key)
+            if output is not None:
+                return output
+
+        if coalesce:
+            coro = _coalesce(
+                key, self._with_session, self._call_tool_impl, tool_name, args
+            )
+        else:
+            coro = self._with_session(
+                self._call_tool_impl, tool_name, args, replay=idempotent
+            )
 
         try:
-            result = run_async_blocking(_run())
-            return json.dumps(result, indent=2, ensure_ascii=False)
+            result = run_async_blocking(coro, timeout=self.valves.timeout)
+            output = _dumps(result, self.valves.pretty_output)
+            if cacheable and not result.get("isError"):
+                _store_response(response_key, output)
+            return output
         except Exception as e:
             return f"Error while calling MCP tool '{tool_name}': {str(e)}"
+
+    # ============================================================
+    # 📊 CACHE STATS
+    # ============================================================
+
+    def mcp_cache_stats(self) -> str:
+        """
+        Statistiques du pool de sessions MCP :
+        - hits / misses
+        - latence d'initialisation (dernière et cumulée, en secondes)
+        - appels identiques fusionnés, réponses servies depuis le cache
+        - sessions ouvertes
+        """
+        stats = dict(_CACHE_STATS)
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / total, 3) if total else 0.0
+        stats["sessions"] = list(_SESSION_CACHE)
+        return _dumps(stats)
+
+    # ============================================================
+    # 🧹 CACHE INVALIDATE
+    # ============================================================
+
+    def mcp_cache_invalidate(self) -> str:
+        """
+        Vide les caches (tools, schémas, sorties JSON) du serveur MCP courant.
+        À utiliser quand les tools du serveur ont changé.
+        """
+        _invalidate_caches(self.mcp_url)
+        return f"Caches MCP vidés pour {self.mcp_url}."
+
+
+@functools.lru_cache(maxsize=None)
+def _default_valves() -> Tools.Valves:
+    return Tools.Valves()